@@ -1,752 +1,1677 @@
-/**
- * SMC Telegram Bot (Binance Futures USDT Perpetual)
- * Режим "рыболовная сеть" включён: больше сигналов, больше шума, потом ужесточим.
- *
- * Запуск:
- *  npm i node-fetch
- *  BOT_TOKEN=... CHAT_ID=... node bot.js
- *
- * Важно:
- * - Все тексты в Telegram на русском, тикер латиницей.
- * - Формат заголовка: "SOLUSDT  |  🔴 ШОРТ" / "BTCUSDT  |  🟢 ЛОНГ"
- */
-
-const fs = require("fs");
-const path = require("path");
-const crypto = require("crypto");
-const fetch = require("node-fetch");
-
-// ========================
-// Конфиг "рыболовная сеть"
-// ========================
-const CFG = {
-  // Binance Futures base
-  BINANCE_FAPI: "https://fapi.binance.com",
-
-  // Telegram
-  BOT_TOKEN: process.env.BOT_TOKEN || "",
-  CHAT_ID: process.env.CHAT_ID || "409865672", // можно переопределить env'ом
-
-  // Сканирование
-  TOP_N_SYMBOLS: 120,
-  MIN_QUOTE_VOLUME_USDT: 1_000_000,
-  SYMBOLS_PER_TICK: 40,
-  TICK_INTERVAL_MS: 25_000,
-
-  // D1 блоки
-  D1_LOOKBACK: 220,
-  D1_PIVOT_LEFT: 2,
-  D1_PIVOT_RIGHT: 2,
-  D1_BLOCK_TOL_PCT: 0.006,
-  MAX_BLOCKS_PER_SYMBOL: 2, // 1 primary + 1 mitigation
-
-  // H1 структура
-  H1_LOOKBACK: 200,
-  H1_PIVOT_LEFT: 1,
-  H1_PIVOT_RIGHT: 1,
-  RETEST_TOL_PCT: 0.005,
-
-  // BOS
-  BOS_MODE: "close_or_wick", // "close_only" или "close_or_wick"
-  BOS_MIN_PCT: 0.0,
-  BOS_WICK_TOL_PCT: 0.0015,
-
-  // Антиспам (ослабленный)
-  SIGNAL_TTL_HOURS: 12,
-
-  // Диагностика
-  DEBUG_PHASE_NOTIFICATIONS: false,
-
-  // Heartbeat: 24/7 раз в час, не зависит от перезапуска
-  HEARTBEAT_EVERY_MS: 60 * 60 * 1000,
-
-  // Лимиты запросов
-  HTTP_TIMEOUT_MS: 12_000,
-  HTTP_MIN_GAP_MS: 220,
-};
-
-// =========
-// Utilities
-// =========
-function nowMs() {
-  return Date.now();
-}
-function sleep(ms) {
-  return new Promise((r) => setTimeout(r, ms));
-}
-function pctTol(price, pct) {
-  return price * pct;
-}
-function clamp(n, a, b) {
-  return Math.max(a, Math.min(b, n));
-}
-function fmt(n) {
-  if (n == null || Number.isNaN(n)) return "—";
-  const abs = Math.abs(n);
-  if (abs >= 1000) return n.toFixed(2);
-  if (abs >= 10) return n.toFixed(3);
-  if (abs >= 1) return n.toFixed(4);
-  return n.toFixed(6);
-}
-function isBull(c) {
-  return c.close > c.open;
-}
-function isBear(c) {
-  return c.close < c.open;
+"""SMC Telegram бот (Binance Futures USDT Perpetual).
+
+Режим "рыболовная сеть" включён: больше сигналов, больше шума, потом ужесточим.
+
+Запуск:
+    pip install -r requirements.txt
+    BOT_TOKEN=... CHAT_ID=... python main.py
+
+Важно:
+ - Все тексты в Telegram на русском, тикер латиницей.
+ - Формат заголовка: "SOLUSDT  |  🔴 ШОРТ" / "BTCUSDT  |  🟢 ЛОНГ"
+"""
+
+import asyncio
+import gzip
+import heapq
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+import requests
+
+try:
+    import orjson
+except ImportError:  # orjson опционален: stdlib json медленнее, но совместим
+    orjson = None
+
+try:
+    from numba import njit
+    _HAVE_NUMBA = True
+except ImportError:  # numba опционален: без него те же кернелы бегут интерпретатором
+    _HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+
+        def deco(fn):
+            return fn
+        return deco
+from numpy.lib.stride_tricks import sliding_window_view
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ========================
+# Конфиг "рыболовная сеть"
+# ========================
+CONFIG: Dict[str, Any] = {
+    # Binance Futures base
+    "BINANCE_FAPI": "https://fapi.binance.com",
+
+    # Telegram
+    "BOT_TOKEN": os.environ.get("BOT_TOKEN", ""),
+    "CHAT_ID": os.environ.get("CHAT_ID", "409865672"),
+
+    # Сканирование
+    "ANALYSIS_WORKERS": 4,
+    "TOP_N_SYMBOLS": 120,
+    "MIN_QUOTE_VOLUME_USDT": 1_000_000,
+    "SYMBOLS_PER_TICK": 40,
+    "TICK_INTERVAL_SEC": 25,
+
+    # D1 блоки
+    "D1_PIVOT_LEFT": 2,
+    "D1_PIVOT_RIGHT": 2,
+    "D1_BLOCK_TOL_PCT": 0.006,
+    "MAX_BLOCKS_PER_SYMBOL": 2,  # 1 движущий + 1 смягчающий
+
+    # H1 структура
+    "H1_PIVOT_LEFT": 1,
+    "H1_PIVOT_RIGHT": 1,
+    "RETEST_TOL_PCT": 0.005,
+
+    # BOS
+    "BOS_MODE": "close_or_wick",  # "close_only" или "close_or_wick"
+    "BOS_MIN_PCT": 0.0,
+    "BOS_WICK_TOL_PCT": 0.0015,
+
+    # Антиспам (ослабленный)
+    "SIGNAL_TTL_HOURS": 12,
+
+    # Кэши
+    "KLINES_CACHE_SEC": 30,
+    # D1 закрывается раз в сутки — держим его заметно дольше, чем H1
+    "KLINES_CACHE_TTL": {"1h": 30, "1d": 900},
+    "UNIVERSE_CACHE_SEC": 600,
+    "EXCHANGE_INFO_CACHE_SEC": 6 * 3600,
+
+    # Лимиты запросов: бюджет веса Binance fapi ~2400/мин, берём с запасом
+    "MAX_CONCURRENT": 8,
+    "HTTP_TIMEOUT_SEC": 12,
+    "HTTP_WEIGHT_PER_MIN": 1800,
+    "HTTP_BURST_WEIGHT": 60,
+    "HTTP_MAX_CONNECTIONS": 32,
+    "HTTP_MAX_PER_HOST": 16,
 }
 
-const STATE_PATH = path.join(__dirname, "state.json");
-function loadState() {
-  try {
-    const raw = fs.readFileSync(STATE_PATH, "utf8");
-    const s = JSON.parse(raw);
-    return {
-      rr_index: s.rr_index || 0,
-      symbols_state: s.symbols_state || {},
-      sent: s.sent || {},
-      metrics: s.metrics || {},
-      last_heartbeat_at_ms: s.last_heartbeat_at_ms || 0,
-      last_cfg_hash: s.last_cfg_hash || "",
-    };
-  } catch {
-    return {
-      rr_index: 0,
-      symbols_state: {},
-      sent: {},
-      metrics: {},
-      last_heartbeat_at_ms: 0,
-      last_cfg_hash: "",
-    };
-  }
-}
-function saveState(state) {
-  fs.writeFileSync(STATE_PATH, JSON.stringify(state, null, 2));
-}
+D1_LOOKBACK_BARS = 220
+H1_LOOKBACK_BARS = 260
 
-// =====================
-// Простенький rate-limit
-// =====================
-let lastHttpAt = 0;
-async function httpGetJson(url) {
-  const gap = nowMs() - lastHttpAt;
-  if (gap < CFG.HTTP_MIN_GAP_MS) await sleep(CFG.HTTP_MIN_GAP_MS - gap);
-  lastHttpAt = nowMs();
-
-  const ctrl = new AbortController();
-  const t = setTimeout(() => ctrl.abort(), CFG.HTTP_TIMEOUT_MS);
-  try {
-    const res = await fetch(url, { signal: ctrl.signal });
-    if (!res.ok) {
-      const text = await res.text().catch(() => "");
-      throw new Error(`HTTP ${res.status}: ${text.slice(0, 160)}`);
-    }
-    return await res.json();
-  } finally {
-    clearTimeout(t);
-  }
-}
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_PATH = os.path.join(BASE_DIR, "data", "state.json")
+KLINES_CACHE_PATH = os.path.join(BASE_DIR, "data", "klines_cache.npz")
+KLINES_CACHE_MANIFEST = os.path.join(BASE_DIR, "data", "klines_cache.json")
+UNIVERSE_CACHE_PATH = os.path.join(BASE_DIR, "data", "universe_cache.json")
+SENT_LOG_PATH = os.path.join(BASE_DIR, "data", "sent.log")
 
-// =====================
-// Binance data functions
-// =====================
-async function fetchExchangeInfo() {
-  return httpGetJson(`${CFG.BINANCE_FAPI}/fapi/v1/exchangeInfo`);
-}
-async function fetch24hTickers() {
-  return httpGetJson(`${CFG.BINANCE_FAPI}/fapi/v1/ticker/24hr`);
-}
-async function fetchKlines(symbol, interval, limit) {
-  const url =
-    `${CFG.BINANCE_FAPI}/fapi/v1/klines?symbol=${encodeURIComponent(symbol)}` +
-    `&interval=${encodeURIComponent(interval)}&limit=${encodeURIComponent(String(limit))}`;
-  const data = await httpGetJson(url);
-  return data.map((k) => ({
-    openTime: k[0],
-    open: Number(k[1]),
-    high: Number(k[2]),
-    low: Number(k[3]),
-    close: Number(k[4]),
-    volume: Number(k[5]),
-    closeTime: k[6],
-    quoteVolume: Number(k[7]),
-  }));
-}
+# Один mkdir на старте вместо stat-сисколла при каждом сохранении
+os.makedirs(os.path.join(BASE_DIR, "data"), exist_ok=True)
 
-async function getTopSymbolsUSDTPerp() {
-  const [ex, tickers] = await Promise.all([fetchExchangeInfo(), fetch24hTickers()]);
+MSK = timezone(timedelta(hours=3))
 
-  const perpSet = new Set(
-    (ex.symbols || [])
-      .filter((s) => s.contractType === "PERPETUAL" && s.quoteAsset === "USDT" && s.status === "TRADING")
-      .map((s) => s.symbol)
-  );
+# =========
+# Утилиты
+# =========
 
-  const filtered = (tickers || [])
-    .filter((t) => perpSet.has(t.symbol))
-    .map((t) => ({ symbol: t.symbol, quoteVolume: Number(t.quoteVolume) }))
-    .filter((x) => Number.isFinite(x.quoteVolume) && x.quoteVolume >= CFG.MIN_QUOTE_VOLUME_USDT)
-    .sort((a, b) => b.quoteVolume - a.quoteVolume)
-    .slice(0, CFG.TOP_N_SYMBOLS);
+@dataclass
+class Candles:
+    """SoA-представление свечей: пять параллельных массивов вместо списка dict'ов."""
 
-  return filtered.map((x) => x.symbol);
-}
+    ts: np.ndarray  # int64, open time (мс)
+    o: np.ndarray   # float64
+    h: np.ndarray
+    l: np.ndarray
+    c: np.ndarray
 
-// =========================
-// Pivot helpers (фракталы)
-// =========================
-function computePivots(candles, left, right) {
-  const pivots = [];
-  for (let i = left; i < candles.length - right; i++) {
-    const c = candles[i];
-    let isHigh = true;
-    let isLow = true;
-
-    for (let j = i - left; j <= i + right; j++) {
-      if (j === i) continue;
-      if (candles[j].high >= c.high) isHigh = false;
-      if (candles[j].low <= c.low) isLow = false;
-      if (!isHigh && !isLow) break;
-    }
+    def __len__(self) -> int:
+        return self.ts.size
 
-    if (isHigh) pivots.push({ i, type: "high", price: c.high, time: c.openTime });
-    if (isLow) pivots.push({ i, type: "low", price: c.low, time: c.openTime });
-  }
-  return pivots;
-}
+    def __getitem__(self, sl: slice) -> "Candles":
+        return Candles(self.ts[sl], self.o[sl], self.h[sl], self.l[sl], self.c[sl])
 
-function lastPivotBefore(pivots, idx, type) {
-  for (let k = pivots.length - 1; k >= 0; k--) {
-    if (pivots[k].i < idx && pivots[k].type === type) return pivots[k];
-  }
-  return null;
-}
 
-// =========================
-// D1 blocks (эвристика)
-// =========================
-function detectD1Blocks(d1Candles) {
-  const pivots = computePivots(d1Candles, CFG.D1_PIVOT_LEFT, CFG.D1_PIVOT_RIGHT);
-  const blocks = [];
-
-  for (let i = CFG.D1_PIVOT_LEFT + 2; i < d1Candles.length; i++) {
-    const c = d1Candles[i];
-
-    const prevHigh = lastPivotBefore(pivots, i, "high");
-    if (prevHigh && c.high > prevHigh.price) {
-      const b = d1Candles[i - 1];
-      if (isBear(b)) {
-        blocks.push({
-          id: `D1P_LONG_${b.openTime}`,
-          side: "long",
-          type: "Движущий",
-          low: b.low,
-          high: b.high,
-          blockTime: b.openTime,
-          brokenSwing: prevHigh.price,
-        });
-      }
-    }
+def pct_tol(price: float, pct: float) -> float:
+    return price * pct
 
-    const prevLow = lastPivotBefore(pivots, i, "low");
-    if (prevLow && c.low < prevLow.price) {
-      const b = d1Candles[i - 1];
-      if (isBull(b)) {
-        blocks.push({
-          id: `D1P_SHORT_${b.openTime}`,
-          side: "short",
-          type: "Движущий",
-          low: b.low,
-          high: b.high,
-          blockTime: b.openTime,
-          brokenSwing: prevLow.price,
-        });
-      }
-    }
-  }
-
-  blocks.sort((a, b) => b.blockTime - a.blockTime);
-  const primary = blocks[0] ? [blocks[0]] : [];
-
-  const mitigation = [];
-  if (primary[0]) {
-    const p = primary[0];
-    const swing = p.brokenSwing;
-    const afterIdx = d1Candles.findIndex((x) => x.openTime === p.blockTime);
-    if (afterIdx >= 0) {
-      for (let i = afterIdx + 1; i < d1Candles.length; i++) {
-        const c = d1Candles[i];
-        const tol = pctTol(swing, 0.0015);
-        const touched = c.low <= swing + tol && c.high >= swing - tol;
-        if (touched) {
-          mitigation.push({
-            id: `D1M_${p.side.toUpperCase()}_${c.openTime}`,
-            side: p.side,
-            type: "Смягчающий",
-            low: Math.min(c.low, swing),
-            high: Math.max(c.high, swing),
-            blockTime: c.openTime,
-            brokenSwing: swing,
-          });
-          break;
-        }
-      }
-    }
-  }
 
-  return [...primary, ...mitigation].slice(0, CFG.MAX_BLOCKS_PER_SYMBOL);
-}
+def candle_body_range(open_: float, close: float) -> Tuple[float, float]:
+    return min(open_, close), max(open_, close)
 
-// =========================
-// H1: касание блока
-// =========================
-function checkTouchH1(block, h1Candle) {
-  const tolLow = block.low * (1 - CFG.D1_BLOCK_TOL_PCT);
-  const tolHigh = block.high * (1 + CFG.D1_BLOCK_TOL_PCT);
 
-  const bodyLow = Math.min(h1Candle.open, h1Candle.close);
-  const bodyHigh = Math.max(h1Candle.open, h1Candle.close);
+def ranges_intersect(a_lo: float, a_hi: float, b_lo: float, b_hi: float) -> bool:
+    return a_lo <= b_hi and a_hi >= b_lo
 
-  const wickTouch = h1Candle.low <= tolHigh && h1Candle.high >= tolLow;
-  const bodyTouch = bodyLow <= tolHigh && bodyHigh >= tolLow;
 
-  if (!wickTouch && !bodyTouch) return null;
-  if (bodyTouch) return "ТЕЛО";
-  return "ТЕНЬ";
-}
+# Векторные аналоги предикатов: то же условие одним ufunc-проходом по окну
+def is_bull_v(o: np.ndarray, c: np.ndarray) -> np.ndarray:
+    return c > o
 
-// =========================
-// H1 структура: P1 динамика, P2/P3 pivots, BOS, ретест
-// =========================
-function updateStructure(symbolState, h1Candles) {
-  const touchTime = symbolState.touch_time;
-  const fromIdx = h1Candles.findIndex((c) => c.openTime >= touchTime);
-  const slice = fromIdx >= 0 ? h1Candles.slice(fromIdx) : h1Candles;
-
-  if (slice.length < 10) return;
-
-  const side = symbolState.side;
-
-  // 1) Динамическая P1
-  if (side === "short") {
-    let maxH = -Infinity;
-    let maxT = null;
-    for (const c of slice) {
-      if (c.high > maxH) {
-        maxH = c.high;
-        maxT = c.openTime;
-      }
-    }
-    const prevP1 = symbolState.p1?.price ?? null;
-    if (prevP1 == null || maxH > prevP1 + 1e-12) {
-      symbolState.p1 = { price: maxH, time: maxT };
-      symbolState.p2 = null;
-      symbolState.p3 = null;
-      symbolState.bos = null;
-      symbolState.phase = "WAIT_BOS";
-    }
-  } else {
-    let minL = Infinity;
-    let minT = null;
-    for (const c of slice) {
-      if (c.low < minL) {
-        minL = c.low;
-        minT = c.openTime;
-      }
-    }
-    const prevP1 = symbolState.p1?.price ?? null;
-    if (prevP1 == null || minL < prevP1 - 1e-12) {
-      symbolState.p1 = { price: minL, time: minT };
-      symbolState.p2 = null;
-      symbolState.p3 = null;
-      symbolState.bos = null;
-      symbolState.phase = "WAIT_BOS";
-    }
-  }
 
-  // 2) Pivot'ы на H1 для P2/P3
-  const pivots = computePivots(slice, CFG.H1_PIVOT_LEFT, CFG.H1_PIVOT_RIGHT);
+def is_bear_v(o: np.ndarray, c: np.ndarray) -> np.ndarray:
+    return c < o
 
-  const p1Time = symbolState.p1?.time;
-  const pivAfterP1 = p1Time ? pivots.filter((p) => slice[p.i].openTime >= p1Time) : pivots;
 
-  if (!symbolState.p2) {
-    if (side === "short") {
-      const p2 = pivAfterP1.find((p) => p.type === "low");
-      if (p2) symbolState.p2 = { price: p2.price, time: slice[p2.i].openTime };
-    } else {
-      const p2 = pivAfterP1.find((p) => p.type === "high");
-      if (p2) symbolState.p2 = { price: p2.price, time: slice[p2.i].openTime };
-    }
-  }
-
-  if (symbolState.p2 && !symbolState.p3) {
-    const p2Time = symbolState.p2.time;
-    const pivAfterP2 = pivAfterP1.filter((p) => slice[p.i].openTime > p2Time);
-    if (side === "short") {
-      const p3 = pivAfterP2.find((p) => p.type === "high");
-      if (p3) symbolState.p3 = { price: p3.price, time: slice[p3.i].openTime };
-    } else {
-      const p3 = pivAfterP2.find((p) => p.type === "low");
-      if (p3) symbolState.p3 = { price: p3.price, time: slice[p3.i].openTime };
-    }
-  }
-
-  // 3) BOS
-  if (symbolState.p2 && !symbolState.bos) {
-    const level = symbolState.p2.price;
-    const last = slice[slice.length - 1];
-
-    const closeBreak =
-      side === "short"
-        ? last.close < level * (1 - CFG.BOS_MIN_PCT)
-        : last.close > level * (1 + CFG.BOS_MIN_PCT);
-
-    let wickBreak = false;
-    if (CFG.BOS_MODE === "close_or_wick") {
-      const tol = pctTol(level, CFG.BOS_WICK_TOL_PCT);
-      wickBreak = side === "short" ? last.low < level - tol : last.high > level + tol;
-    }
+def ranges_intersect_v(a_lo: np.ndarray, a_hi: np.ndarray, b_lo: Any, b_hi: Any) -> np.ndarray:
+    return (a_lo <= b_hi) & (a_hi >= b_lo)
 
-    if (closeBreak || wickBreak) {
-      symbolState.bos = {
-        level,
-        time: last.openTime,
-        close: last.close,
-        mode: closeBreak ? "подтверждён закрытием" : "прокол уровня (по тени)",
-      };
-      symbolState.phase = "WAIT_RETEST";
-    }
-  }
-
-  // 4) Ретест
-  if (symbolState.phase === "WAIT_RETEST" && symbolState.bos) {
-    const last = slice[slice.length - 1];
-    const levels = [];
-    if (symbolState.p2) levels.push({ name: "P2", price: symbolState.p2.price });
-    if (symbolState.p3) levels.push({ name: "P3", price: symbolState.p3.price });
-
-    for (const lv of levels) {
-      const tol = pctTol(lv.price, CFG.RETEST_TOL_PCT);
-      const touched = last.low <= lv.price + tol && last.high >= lv.price - tol;
-      if (touched) {
-        symbolState.retest = { levelName: lv.name, time: last.openTime };
-        symbolState.phase = "SIGNAL_READY";
-        break;
-      }
-    }
-  }
-}
 
-// =========================
-// Telegram
-// =========================
-async function sendTelegram(text) {
-  if (!CFG.BOT_TOKEN || !CFG.CHAT_ID) throw new Error("Не задан BOT_TOKEN или CHAT_ID");
-  const url = `https://api.telegram.org/bot${CFG.BOT_TOKEN}/sendMessage`;
-  const body = { chat_id: CFG.CHAT_ID, text };
-  const res = await fetch(url, {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(body),
-  });
-  if (!res.ok) {
-    const t = await res.text().catch(() => "");
-    throw new Error(`Telegram error ${res.status}: ${t.slice(0, 200)}`);
-  }
-}
+# Формат цены на инструмент стабилен между тиками — выбираем спеку один раз
+_FMT_CACHE: Dict[str, str] = {}
 
-function directionHeader(symbol, side) {
-  return side === "long" ? `${symbol}  |  🟢 ЛОНГ` : `${symbol}  |  🔴 ШОРТ`;
-}
 
-function formatSignalMessage(symbol, st) {
-  const lines = [];
-  lines.push(directionHeader(symbol, st.side));
-  lines.push("");
-  lines.push(`Тип D1 блока: ${st.block_type}`);
-  lines.push(`Диапазон D1: ${fmt(st.block_low)} – ${fmt(st.block_high)}`);
-  lines.push("");
-  lines.push(`Касание блока: ${st.touch_kind}`);
-  lines.push(`P1: ${fmt(st.p1?.price)}`);
-  lines.push(`P2: ${fmt(st.p2?.price)}`);
-  lines.push(`P3: ${fmt(st.p3?.price)}`);
-  lines.push("");
-  if (st.bos) {
-    const dirText = st.side === "long" ? "выше" : "ниже";
-    lines.push(`Слом структуры (BOS): ${st.bos.mode}`);
-    lines.push(`Уровень BOS (P2): ${fmt(st.bos.level)}`);
-    lines.push(`Закрытие: ${fmt(st.bos.close)} (${dirText} уровня)`);
-  } else {
-    lines.push("Слом структуры (BOS): —");
-  }
-  lines.push(st.retest ? `Ретест: ${st.retest.levelName}` : "Ретест: —");
-  return lines.join("\n");
-}
+def _price_fmt_spec(ref: float) -> str:
+    ax = abs(ref)
+    if ax >= 1000:
+        return "%.2f"
+    if ax >= 10:
+        return "%.3f"
+    if ax >= 1:
+        return "%.4f"
+    return "%.6f"
 
-function formatPhaseMessage(symbol, st) {
-  const humanPhase =
-    st.phase === "WAIT_D1_TOUCH"
-      ? "Ожидание касания D1 блока"
-      : st.phase === "WAIT_BOS"
-      ? "Касание было, жду слом структуры"
-      : st.phase === "WAIT_RETEST"
-      ? "Слом был, жду ретест"
-      : st.phase === "SIGNAL_READY"
-      ? "Сигнал готов"
-      : "—";
-  return `${symbol}  |  ℹ️ ${humanPhase}`;
-}
 
-// =========================
-// Антиспам
-// =========================
-function shouldSendByTtl(sentMap, symbol, touchId) {
-  if (!sentMap[symbol]) return true;
-  const ts = sentMap[symbol][touchId];
-  if (!ts) return true;
-  const ageH = (nowMs() - ts) / (1000 * 60 * 60);
-  return ageH >= CFG.SIGNAL_TTL_HOURS;
-}
-function markSent(sentMap, symbol, touchId) {
-  if (!sentMap[symbol]) sentMap[symbol] = {};
-  sentMap[symbol][touchId] = nowMs();
-}
+def fmt_price_for(symbol: str, x: Optional[float]) -> str:
+    if x is None or x != x:
+        return "—"
+    spec = _FMT_CACHE.get(symbol)
+    if spec is None:
+        spec = _FMT_CACHE[symbol] = _price_fmt_spec(x)
+    return spec % x
 
-// =========================
-// Heartbeat + "настройки обновлены"
-// =========================
-function cfgPublicSnapshot() {
-  // Только то, что реально важно видеть в чате
-  return {
-    TOP_N_SYMBOLS: CFG.TOP_N_SYMBOLS,
-    MIN_QUOTE_VOLUME_USDT: CFG.MIN_QUOTE_VOLUME_USDT,
-    SYMBOLS_PER_TICK: CFG.SYMBOLS_PER_TICK,
-    D1_BLOCK_TOL_PCT: CFG.D1_BLOCK_TOL_PCT,
-    H1_PIVOT_LEFT: CFG.H1_PIVOT_LEFT,
-    H1_PIVOT_RIGHT: CFG.H1_PIVOT_RIGHT,
-    BOS_MODE: CFG.BOS_MODE,
-    BOS_WICK_TOL_PCT: CFG.BOS_WICK_TOL_PCT,
-    RETEST_TOL_PCT: CFG.RETEST_TOL_PCT,
-    SIGNAL_TTL_HOURS: CFG.SIGNAL_TTL_HOURS,
-    HEARTBEAT_EVERY_MIN: Math.round(CFG.HEARTBEAT_EVERY_MS / 60000),
-  };
-}
 
-function cfgHash(snapshot) {
-  const json = JSON.stringify(snapshot);
-  return crypto.createHash("sha256").update(json).digest("hex");
-}
+def json_loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
 
-async function notifyIfCfgChanged(state) {
-  const snap = cfgPublicSnapshot();
-  const h = cfgHash(snap);
-  if (h === state.last_cfg_hash) return;
 
-  const lines = [];
-  lines.push("⚙️ Настройки обновлены");
-  for (const [k, v] of Object.entries(snap)) lines.push(`${k}: ${v}`);
+def json_dumps_bytes(obj: Any, pretty: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    s = json.dumps(obj, ensure_ascii=False, indent=2 if pretty else None)
+    return s.encode("utf-8")
 
-  await sendTelegram(lines.join("\n"));
-  state.last_cfg_hash = h;
-}
 
-function summarizePhases(state, symbols) {
-  let a = 0,
-    b = 0,
-    c = 0,
-    other = 0,
-    r = 0;
-  for (const s of symbols) {
-    const st = state.symbols_state[s];
-    const ph = st?.phase || "WAIT_D1_TOUCH";
-    if (ph === "WAIT_D1_TOUCH") a++;
-    else if (ph === "WAIT_BOS") b++;
-    else if (ph === "WAIT_RETEST") c++;
-    else if (ph === "SIGNAL_READY") r++;
-    else other++;
-  }
-  return { a, b, c, other, r };
-}
+@lru_cache(maxsize=4096)
+def fmt_ts(ts_ms: int) -> str:
+    # Метки блока/касания/BOS повторяются из тика в тик до смены сессии
+    return datetime.fromtimestamp(ts_ms / 1000, tz=MSK).strftime("%d.%m %H:%M")
 
-async function maybeHeartbeat(state, symbols) {
-  const last = state.last_heartbeat_at_ms || 0;
-  const due = nowMs() - last >= CFG.HEARTBEAT_EVERY_MS;
 
-  if (!due) return;
+# =========================
+# Состояние (state.json)
+# =========================
 
-  const { a, b, c, other, r } = summarizePhases(state, symbols);
-  const m = state.metrics || {};
-  const dt = new Date().toISOString().replace("T", " ").slice(0, 19);
+SENT_MAX_ENTRIES = 6000
 
-  const lines = [];
-  lines.push(`💓 Хартбит (${dt} UTC)`);
-  lines.push(`Инструментов: ${symbols.length}`);
-  lines.push(`Фазы: касание ${a} | слом ${b} | ретест ${c} | сигнал готов ${r} | прочее ${other}`);
-  lines.push(`За сутки: касаний ${m.touches || 0} | BOS ${m.bos || 0} | ретестов ${m.retests || 0} | сигналов ${m.signals || 0}`);
-  if (m.last_error) lines.push(`Ошибка: ${m.last_error}`);
+# Append-only журнал mark_sent: O(1) запись на сигнал, без переписывания файла.
+# Снапшот state.json пишется debounce-флашем; журнал докатывает то, что флаш
+# ещё не успел забрать (падение между сигналом и концом тика ничего не теряет).
+_SENT_LOG_FH: Optional[Any] = None
 
-  await sendTelegram(lines.join("\n"));
-  state.last_heartbeat_at_ms = nowMs();
-}
 
-// =========================
-// Core loop
-// =========================
-async function processSymbol(state, symbol) {
-  const symState = state.symbols_state[symbol] || { phase: "WAIT_D1_TOUCH" };
-
-  const [d1, h1] = await Promise.all([fetchKlines(symbol, "1d", CFG.D1_LOOKBACK), fetchKlines(symbol, "1h", CFG.H1_LOOKBACK)]);
-  if (!d1.length || !h1.length) return;
-
-  const blocks = detectD1Blocks(d1);
-  if (!blocks.length) {
-    symState.phase = "WAIT_D1_TOUCH";
-    state.symbols_state[symbol] = symState;
-    return;
-  }
-
-  // A) ждём касание
-  if (symState.phase === "WAIT_D1_TOUCH") {
-    const lastH1 = h1[h1.length - 1];
-
-    for (const b of blocks) {
-      const touchKind = checkTouchH1(b, lastH1);
-      if (touchKind) {
-        const touchId = `${b.id}:${lastH1.openTime}`;
-
-        symState.phase = "WAIT_BOS";
-        symState.side = b.side;
-        symState.touch_id = touchId;
-        symState.touch_time = lastH1.openTime;
-        symState.touch_kind = touchKind;
-
-        symState.block_id = b.id;
-        symState.block_type = b.type;
-        symState.block_low = b.low;
-        symState.block_high = b.high;
-
-        symState.p1 = null;
-        symState.p2 = null;
-        symState.p3 = null;
-        symState.bos = null;
-        symState.retest = null;
-
-        state.metrics.touches = (state.metrics.touches || 0) + 1;
-
-        if (CFG.DEBUG_PHASE_NOTIFICATIONS) {
-          await sendTelegram(formatPhaseMessage(symbol, symState));
-        }
-        break;
-      }
-    }
-  }
+def _sent_log_append(key: str, ts: int) -> None:
+    global _SENT_LOG_FH
+    try:
+        if _SENT_LOG_FH is None:
+            _SENT_LOG_FH = open(SENT_LOG_PATH, "a", encoding="utf-8", buffering=1)
+        _SENT_LOG_FH.write(f"{key}\t{ts}\n")
+    except OSError:
+        pass
 
-  // B/C) структура + BOS + ретест
-  if (symState.phase === "WAIT_BOS" || symState.phase === "WAIT_RETEST") {
-    const prevBosTime = symState.bos?.time || null;
 
-    updateStructure(symState, h1);
+def _sent_log_replay(sent: "OrderedDict[str, int]") -> None:
+    try:
+        with open(SENT_LOG_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                key, _, ts = line.rstrip("\n").partition("\t")
+                if key:
+                    sent[key] = int(ts) if ts else 0
+                    sent.move_to_end(key)
+    except (OSError, ValueError):
+        pass
 
-    if (symState.bos && symState.bos.time !== prevBosTime) {
-      state.metrics.bos = (state.metrics.bos || 0) + 1;
-      if (CFG.DEBUG_PHASE_NOTIFICATIONS) {
-        await sendTelegram(formatPhaseMessage(symbol, symState));
-      }
-    }
 
-    if (symState.retest && symState.phase === "SIGNAL_READY") {
-      state.metrics.retests = (state.metrics.retests || 0) + 1;
-    }
-  }
-
-  // SIGNAL_READY) антиспам + отправка
-  if (symState.phase === "SIGNAL_READY") {
-    const touchId = symState.touch_id;
-    if (touchId && shouldSendByTtl(state.sent, symbol, touchId)) {
-      const msg = formatSignalMessage(symbol, symState);
-      await sendTelegram(msg);
-      markSent(state.sent, symbol, touchId);
-      state.metrics.signals = (state.metrics.signals || 0) + 1;
+def _sent_log_truncate() -> None:
+    global _SENT_LOG_FH
+    if _SENT_LOG_FH is not None:
+        _SENT_LOG_FH.close()
+        _SENT_LOG_FH = None
+    try:
+        open(SENT_LOG_PATH, "w", encoding="utf-8").close()
+    except OSError:
+        pass
+
+
+def _default_state() -> Dict[str, Any]:
+    return {
+        "rr_index": 0,
+        "sessions": {},
+        "sent": OrderedDict(),
+        "metrics": {},
+        "last_heartbeat_hour_key": "",
+        "last_cfg_hash": "",
     }
-    symState.phase = "WAIT_D1_TOUCH";
-  }
 
-  state.symbols_state[symbol] = symState;
-}
 
-async function main() {
-  if (!CFG.BOT_TOKEN) {
-    console.log("Ошибка: не задан BOT_TOKEN. Пример: BOT_TOKEN=123:ABC CHAT_ID=... node bot.js");
-    process.exit(1);
-  }
-
-  const state = loadState();
-  if (!state.metrics) state.metrics = {};
-
-  let symbols = [];
-  try {
-    symbols = await getTopSymbolsUSDTPerp();
-    console.log(`Загружено символов: ${symbols.length}`);
-  } catch (e) {
-    console.error("Не удалось получить список символов:", e);
-    process.exit(1);
-  }
-
-  // 1) Уведомление, что настройки изменились (после деплоя/изменения CFG)
-  try {
-    await notifyIfCfgChanged(state);
-    saveState(state);
-  } catch (e) {
-    state.metrics.last_error = `Настройки: ${String(e.message || e).slice(0, 180)}`;
-    saveState(state);
-  }
-
-  // 2) Если хартбита ещё не было вообще, можно сразу дать первый пинг
-  if (!state.last_heartbeat_at_ms) {
-    try {
-      await maybeHeartbeat(state, symbols);
-      saveState(state);
-    } catch (e) {
-      state.metrics.last_error = `Хартбит старт: ${String(e.message || e).slice(0, 180)}`;
-      saveState(state);
+def _load_state() -> Dict[str, Any]:
+    try:
+        with open(STATE_PATH, "rb") as f:
+            raw = f.read()
+        if raw[:2] == b"\x1f\x8b":
+            raw = gzip.decompress(raw)
+        st = json_loads(raw)
+    except (OSError, ValueError):
+        st = {}
+    out = _default_state()
+    out.update(st)
+    # Просроченные по TTL записи выбрасываем сразу, чтобы не сериализовать их зря;
+    # чужой формат sent (вложенные словари старого бота, ручные правки) не должен
+    # ронять загрузку — тогда начинаем с пустого и добираем из журнала
+    try:
+        sent = OrderedDict(out["sent"])
+        cutoff = time.time() - CONFIG["SIGNAL_TTL_HOURS"] * 3600
+        for k in [k for k, v in sent.items() if float(v) < cutoff]:
+            del sent[k]
+    except (TypeError, ValueError):
+        sent = OrderedDict()
+    out["sent"] = sent
+    _sent_log_replay(out["sent"])
+    while len(out["sent"]) > SENT_MAX_ENTRIES:
+        out["sent"].popitem(last=False)
+    return out
+
+
+STATE_GZIP_THRESHOLD = 64 * 1024
+
+
+def _save_state(st: Dict[str, Any]) -> None:
+    data = json_dumps_bytes(st)
+    if len(data) > STATE_GZIP_THRESHOLD:
+        # gzip-магия в первых байтах служит сентинелом при загрузке
+        data = gzip.compress(data, 1)
+    tmp = STATE_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, STATE_PATH)
+
+
+# Состояние живёт в памяти: диск читается один раз, пишется debounce-флашем в конце тика.
+# Два уровня грязи: critical (sent/sessions/heartbeat/cfg — пишем каждый тик)
+# и minor (rr_index/metrics — достаточно раз в STATE_MINOR_FLUSH_SEC)
+_STATE: Optional[Dict[str, Any]] = None
+_STATE_DIRTY = False
+_STATE_DIRTY_MINOR = False
+_STATE_LOCK = threading.Lock()
+_LAST_FLUSH_MONO = time.monotonic()
+STATE_MINOR_FLUSH_SEC = 60.0
+
+
+def _get_state() -> Dict[str, Any]:
+    global _STATE
+    if _STATE is None:
+        with _STATE_LOCK:
+            if _STATE is None:
+                _STATE = _load_state()
+    return _STATE
+
+
+def _mark_state_dirty(minor: bool = False) -> None:
+    global _STATE_DIRTY, _STATE_DIRTY_MINOR
+    if minor:
+        _STATE_DIRTY_MINOR = True
+    else:
+        _STATE_DIRTY = True
+
+
+def _gc_state(st: Dict[str, Any]) -> None:
+    """Выбрасывает мёртвые записи перед снапшотом: просроченный sent и сессии,
+    чьё касание уже вышло за окно H1 (сигналов по ним больше не будет)."""
+    sent: OrderedDict = st["sent"]
+    cutoff = time.time() - CONFIG["SIGNAL_TTL_HOURS"] * 3600
+    for k in [k for k, v in sent.items() if float(v) < cutoff]:
+        del sent[k]
+    sessions: Dict[str, Any] = st["sessions"]
+    horizon_ms = int((time.time() - (H1_LOOKBACK_BARS + 24) * 3600) * 1000)
+    for k in [
+        k for k, v in sessions.items()
+        if not isinstance(v, dict) or int(v.get("ts", 0)) < horizon_ms
+    ]:
+        del sessions[k]
+
+
+def flush_state(force: bool = False) -> None:
+    global _STATE_DIRTY, _STATE_DIRTY_MINOR, _LAST_FLUSH_MONO
+    if _STATE is None:
+        return
+    if not _STATE_DIRTY and not _STATE_DIRTY_MINOR:
+        return
+    now = time.monotonic()
+    if not _STATE_DIRTY and not force and now - _LAST_FLUSH_MONO < STATE_MINOR_FLUSH_SEC:
+        return  # только счётчики/rr_index — пишем не чаще раза в минуту
+    with _STATE_LOCK:
+        _gc_state(_STATE)
+        _save_state(_STATE)
+        # Снапшот покрыл журнал — компактируем его в ноль
+        _sent_log_truncate()
+        _STATE_DIRTY = False
+        _STATE_DIRTY_MINOR = False
+        _LAST_FLUSH_MONO = now
+
+
+def get_symbol_session_id(key: str) -> Optional[str]:
+    sess = _get_state()["sessions"].get(key)
+    return sess.get("id") if isinstance(sess, dict) else sess
+
+
+def set_symbol_session_id(key: str, session_id: str, ts: int = 0) -> None:
+    # Новая сессия сбрасывает отметки этапов (bos/retest) прошлой
+    st = _get_state()
+    with _STATE_LOCK:
+        st["sessions"][key] = {"id": session_id, "ts": int(ts)}
+    _mark_state_dirty()
+
+
+def mark_session_stage(key: str, stage: str, ts: int) -> bool:
+    """Отмечает этап сессии (bos/retest); True — этап с таким ts ещё не считан."""
+    st = _get_state()
+    with _STATE_LOCK:
+        sess = st["sessions"].get(key)
+        if not isinstance(sess, dict):
+            sess = {"id": sess, "ts": 0}
+            st["sessions"][key] = sess
+        if sess.get(stage) == int(ts):
+            return False
+        sess[stage] = int(ts)
+    _mark_state_dirty()
+    return True
+
+
+def was_sent(key: str) -> bool:
+    st = _get_state()
+    with _STATE_LOCK:
+        sent: OrderedDict = st["sent"]
+        ts = sent.get(key)
+        if ts is None:
+            return False
+        if time.time() - float(ts) > CONFIG["SIGNAL_TTL_HOURS"] * 3600:
+            # TTL истёк — запись больше не блокирует повторный сигнал
+            del sent[key]
+        else:
+            return True
+    _mark_state_dirty()
+    return False
+
+
+def mark_sent(key: str) -> None:
+    st = _get_state()
+    now = int(time.time())
+    with _STATE_LOCK:
+        sent: OrderedDict = st["sent"]
+        sent[key] = now
+        sent.move_to_end(key)
+        # Амортизированный O(1) LRU-кэп вместо полной пересборки dict'а
+        while len(sent) > SENT_MAX_ENTRIES:
+            sent.popitem(last=False)
+    _sent_log_append(key, now)
+    _mark_state_dirty()
+
+
+def get_rr_index() -> int:
+    return int(_get_state()["rr_index"])
+
+
+def set_rr_index(i: int) -> None:
+    _get_state()["rr_index"] = int(i)
+    _mark_state_dirty(minor=True)
+
+
+def get_last_heartbeat_hour_key() -> str:
+    return _get_state()["last_heartbeat_hour_key"]
+
+
+def set_last_heartbeat_hour_key(key: str) -> None:
+    _get_state()["last_heartbeat_hour_key"] = key
+    _mark_state_dirty()
+
+
+def bump_metric(name: str, inc: int = 1) -> None:
+    st = _get_state()
+    with _STATE_LOCK:
+        st["metrics"][name] = int(st["metrics"].get(name, 0)) + inc
+    _mark_state_dirty(minor=True)
+
+
+def set_last_error(text: str) -> None:
+    st = _get_state()
+    with _STATE_LOCK:
+        st["metrics"]["last_error"] = text[:180]
+    _mark_state_dirty(minor=True)
+
+
+# =====================
+# HTTP + кэши
+# =====================
+# Значение кэша — кортеж (expiry по time.monotonic, данные): один анпак на хит,
+# и TTL не плывёт от NTP-подводок системных часов
+_KLINES_CACHE: Dict[str, Tuple[float, Candles]] = {}
+_UNIVERSE_CACHE: Dict[str, Any] = {"expiry": 0.0, "data": [], "allowed": [], "allowed_expiry": 0.0}
+
+# Один Session на процесс: keep-alive вместо TCP+TLS рукопожатия на каждый запрос
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    ),
+)
+_SESSION.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+
+class TokenBucket:
+    """Лимитер по бюджету веса: непрерывное пополнение, ограниченный burst.
+
+    В отличие от фиксированного зазора между запросами, позволяет волне
+    prefetch'а уйти сразу (пока есть токены) и упирается в лимит только
+    на устоявшемся темпе.
+    """
+
+    def __init__(self, rate_per_min: float, capacity: float) -> None:
+        self.rate = rate_per_min / 60.0
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, weight: float) -> float:
+        """Списывает weight токенов, возвращает паузу до их доступности."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= weight
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, weight: float = 1.0) -> None:
+        delay = self._reserve(weight)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, weight: float = 1.0) -> None:
+        delay = self._reserve(weight)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def penalize(self, seconds: float) -> None:
+        """Опустошает ведро после 429: следующий запрос ждёт не меньше seconds."""
+        with self._lock:
+            self.updated = time.monotonic()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+_HTTP_BUCKET = TokenBucket(CONFIG["HTTP_WEIGHT_PER_MIN"], CONFIG["HTTP_BURST_WEIGHT"])
+
+
+def _url_weight(url: str) -> float:
+    """Вес запроса по тарифам Binance Futures (klines зависит от limit)."""
+    if "/fapi/v1/klines" in url:
+        i = url.find("limit=")
+        limit = int(url[i + 6:].split("&", 1)[0]) if i >= 0 else 500
+        if limit < 100:
+            return 1.0
+        return 2.0 if limit < 500 else 5.0
+    if "/fapi/v1/ticker/24hr" in url:
+        return 40.0  # без symbol отдаёт весь рынок
+    return 1.0
+
+
+def http_get_json(url: str) -> Any:
+    _HTTP_BUCKET.acquire(_url_weight(url))
+    r = _SESSION.get(url, timeout=CONFIG["HTTP_TIMEOUT_SEC"])
+    if r.status_code != 200:
+        raise RuntimeError(f"HTTP {r.status_code}: {r.text[:160]}")
+    return json_loads(r.content)
+
+
+# Условные запросы: ETag/Last-Modified, на 304 отдаём распарсенное из памяти
+_COND_CACHE: Dict[str, Dict[str, Any]] = {}
+
+
+def http_get_json_conditional(url: str) -> Any:
+    _HTTP_BUCKET.acquire(_url_weight(url))
+    entry = _COND_CACHE.get(url)
+    headers: Dict[str, str] = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    r = _SESSION.get(url, timeout=CONFIG["HTTP_TIMEOUT_SEC"], headers=headers)
+    if r.status_code == 304 and entry:
+        return entry["data"]
+    if r.status_code != 200:
+        raise RuntimeError(f"HTTP {r.status_code}: {r.text[:160]}")
+    data = json_loads(r.content)
+    _COND_CACHE[url] = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "data": data,
+    }
+    return data
+
+
+def _parse_klines(data: List[List[Any]]) -> Candles:
+    if not data:
+        empty = np.empty(0, dtype=np.float64)
+        return Candles(np.empty(0, dtype=np.int64), empty, empty, empty, empty)
+    # Транспонируем строки и кастим только пять нужных колонок — без
+    # промежуточной object-матрицы 12×N (объём, trades и т.п. не трогаем)
+    ts_c, o_c, h_c, l_c, c_c, *_ = zip(*data)
+    return Candles(
+        ts=np.array(ts_c, dtype=np.int64),
+        o=np.array(o_c, dtype=np.float64),
+        h=np.array(h_c, dtype=np.float64),
+        l=np.array(l_c, dtype=np.float64),
+        c=np.array(c_c, dtype=np.float64),
+    )
+
+
+# URL'ы klines детерминированы по (symbol, interval, limit) — собираем один раз
+_URL_CACHE: Dict[Tuple[str, str, int], str] = {}
+
+
+def _klines_url(symbol: str, interval: str, limit: int) -> str:
+    key = (symbol, interval, limit)
+    url = _URL_CACHE.get(key)
+    if url is None:
+        url = (
+            f"{CONFIG['BINANCE_FAPI']}/fapi/v1/klines"
+            f"?symbol={symbol}&interval={interval}&limit={limit}"
+        )
+        _URL_CACHE[key] = url
+    return url
+
+
+_INTERVAL_MS = {"1h": 3_600_000, "1d": 86_400_000}
+
+
+def _incremental_start(base: Optional[Candles], interval: str, limit: int) -> Optional[int]:
+    """startTime для дозагрузки хвоста, либо None — качать окно целиком.
+
+    Протухшая запись кэша остаётся базой: в steady-state докачиваем 1-2 бара
+    вместо всего окна. Последний (открытый) бар волатилен, поэтому startTime
+    ставим на него — он перекачивается заново.
+    """
+    if base is None or not len(base):
+        return None
+    step = _INTERVAL_MS.get(interval)
+    if step is None:
+        return None
+    last_ts = int(base.ts[-1])
+    # отстали сильнее, чем на окно — дозагрузка пропустила бы свежие бары
+    if (time.time() * 1000 - last_ts) / step >= limit - 2:
+        return None
+    return last_ts
+
+
+def _merge_klines(base: Candles, fresh: Candles, limit: int) -> Candles:
+    if not len(fresh):
+        return base
+    keep = base.ts < fresh.ts[0]
+    merged = Candles(
+        ts=np.concatenate((base.ts[keep], fresh.ts)),
+        o=np.concatenate((base.o[keep], fresh.o)),
+        h=np.concatenate((base.h[keep], fresh.h)),
+        l=np.concatenate((base.l[keep], fresh.l)),
+        c=np.concatenate((base.c[keep], fresh.c)),
+    )
+    if len(merged) > limit:
+        merged = merged[-limit:]
+    return merged
+
+
+def _persist_caches() -> None:
+    """Сбрасывает TTL-кэши на диск: рестарт в пределах TTL не дёргает API заново.
+
+    Массивы — бинарно через np.savez (JSON для свечей раздувается в разы),
+    манифест с ts по ключам — рядом в JSON.
+    """
+    now_mono = time.monotonic()
+
+    # monotonic не переживает рестарт — на диск кладём остаток TTL + wall-метку
+    manifest: Dict[str, Any] = {"_saved_at": time.time(), "entries": {}}
+    arrays: Dict[str, np.ndarray] = {}
+    for idx, (key, (expiry, candles)) in enumerate(list(_KLINES_CACHE.items())):
+        remaining = expiry - now_mono
+        if remaining <= 0:
+            continue
+        manifest["entries"][key] = {"i": idx, "remaining": remaining}
+        for field in ("ts", "o", "h", "l", "c"):
+            arrays[f"{idx}:{field}"] = getattr(candles, field)
+
+    tmp = KLINES_CACHE_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, KLINES_CACHE_PATH)
+    tmp = KLINES_CACHE_MANIFEST + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(json_dumps_bytes(manifest))
+    os.replace(tmp, KLINES_CACHE_MANIFEST)
+
+    uni_disk = {
+        "saved_at": time.time(),
+        "remaining": _UNIVERSE_CACHE["expiry"] - now_mono,
+        "data": _UNIVERSE_CACHE["data"],
+        "allowed": _UNIVERSE_CACHE["allowed"],
+        "allowed_remaining": _UNIVERSE_CACHE["allowed_expiry"] - now_mono,
     }
-  }
-
-  while (true) {
-    try {
-      // Хартбит по таймеру (24/7, независимо от минуты, с памятью в state.json)
-      try {
-        await maybeHeartbeat(state, symbols);
-      } catch (e) {
-        state.metrics.last_error = `Хартбит: ${String(e.message || e).slice(0, 180)}`;
-      }
-
-      const n = symbols.length;
-      const batchSize = clamp(CFG.SYMBOLS_PER_TICK, 1, n || 1);
-      const start = state.rr_index % (n || 1);
-      const batch = [];
-      for (let k = 0; k < batchSize; k++) batch.push(symbols[(start + k) % n]);
-      state.rr_index = (start + batchSize) % (n || 1);
-
-      for (const s of batch) {
-        try {
-          await processSymbol(state, s);
-        } catch (e) {
-          state.metrics.last_error = `${s}: ${String(e.message || e).slice(0, 180)}`;
+    tmp = UNIVERSE_CACHE_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(json_dumps_bytes(uni_disk))
+    os.replace(tmp, UNIVERSE_CACHE_PATH)
+
+
+def _load_disk_caches() -> None:
+    """Тёплый старт: подхватывает ещё не протухшие кэши с прошлого запуска."""
+    try:
+        with open(KLINES_CACHE_MANIFEST, "rb") as f:
+            manifest = json_loads(f.read())
+        age = time.time() - manifest.get("_saved_at", 0.0)
+        with np.load(KLINES_CACHE_PATH) as npz:
+            for key, meta in manifest.get("entries", {}).items():
+                remaining = meta["remaining"] - age
+                if remaining <= 0:
+                    continue
+                idx = meta["i"]
+                candles = Candles(*(npz[f"{idx}:{field}"] for field in ("ts", "o", "h", "l", "c")))
+                _KLINES_CACHE[key] = (time.monotonic() + remaining, candles)
+    except (OSError, ValueError, KeyError):
+        pass
+    try:
+        with open(UNIVERSE_CACHE_PATH, "rb") as f:
+            uni = json_loads(f.read())
+        age = time.time() - uni.get("saved_at", 0.0)
+        if uni.get("remaining", 0.0) - age > 0 and uni.get("data"):
+            _UNIVERSE_CACHE["expiry"] = time.monotonic() + uni["remaining"] - age
+            _UNIVERSE_CACHE["data"] = uni["data"]
+        if uni.get("allowed_remaining", 0.0) - age > 0 and uni.get("allowed"):
+            _UNIVERSE_CACHE["allowed_expiry"] = time.monotonic() + uni["allowed_remaining"] - age
+            _UNIVERSE_CACHE["allowed"] = uni["allowed"]
+    except (OSError, ValueError):
+        pass
+
+
+# Single-flight: одновременные запросы одного и того же ключа сливаются в один фетч
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+_SYNC_FETCH_LOCKS: Dict[str, threading.Lock] = {}
+_SYNC_FETCH_LOCKS_GUARD = threading.Lock()
+
+
+def _klines_ttl(interval: str) -> float:
+    ttl = CONFIG["KLINES_CACHE_TTL"].get(interval, CONFIG["KLINES_CACHE_SEC"])
+    # Новый дневной бар появляется в полночь UTC — TTL не должен её перешагивать
+    to_midnight = 86400.0 - (time.time() % 86400.0)
+    return min(ttl, max(to_midnight, 1.0))
+
+
+def get_klines(symbol: str, interval: str, limit: int) -> Candles:
+    cache_key = f"{symbol}:{interval}:{limit}"
+    entry = _KLINES_CACHE.get(cache_key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    with _SYNC_FETCH_LOCKS_GUARD:
+        lock = _SYNC_FETCH_LOCKS.setdefault(cache_key, threading.Lock())
+    with lock:
+        # Пока ждали лок, сосед мог уже положить свежие данные
+        entry = _KLINES_CACHE.get(cache_key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        base = entry[1] if entry else None
+        start = _incremental_start(base, interval, limit)
+        url = _klines_url(symbol, interval, limit)
+        if start is not None:
+            url += f"&startTime={start}"
+        fresh = _parse_klines(http_get_json(url))
+        candles = _merge_klines(base, fresh, limit) if start is not None else fresh
+        _KLINES_CACHE[cache_key] = (time.monotonic() + _klines_ttl(interval), candles)
+    return candles
+
+
+# --- async-слой: все klines батча летят параллельно через один ClientSession ---
+_AIO_SESSION: Optional[aiohttp.ClientSession] = None
+_AIO_SEM: Optional[asyncio.Semaphore] = None
+
+
+async def _aio_session() -> aiohttp.ClientSession:
+    global _AIO_SESSION, _AIO_SEM
+    if _AIO_SESSION is None or _AIO_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONFIG["HTTP_MAX_CONNECTIONS"],
+            limit_per_host=CONFIG["HTTP_MAX_PER_HOST"],
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(total=CONFIG["HTTP_TIMEOUT_SEC"])
+        _AIO_SESSION = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        # Семафор держит одновременные запросы к бирже в рамках лимитов
+        _AIO_SEM = asyncio.Semaphore(CONFIG["MAX_CONCURRENT"])
+    return _AIO_SESSION
+
+
+async def http_get_json_async(url: str) -> Any:
+    session = await _aio_session()
+    weight = _url_weight(url)
+    for attempt in range(2):
+        await _HTTP_BUCKET.acquire_async(weight)
+        async with _AIO_SEM, session.get(url) as r:
+            if r.status == 429 and attempt == 0:
+                retry_after = float(r.headers.get("Retry-After", "2"))
+                _HTTP_BUCKET.penalize(retry_after)
+                await asyncio.sleep(min(retry_after, 60.0))
+                continue
+            if r.status != 200:
+                text = await r.text()
+                raise RuntimeError(f"HTTP {r.status}: {text[:160]}")
+            return json_loads(await r.read())
+
+
+async def get_klines_async(symbol: str, interval: str, limit: int) -> Candles:
+    cache_key = f"{symbol}:{interval}:{limit}"
+    entry = _KLINES_CACHE.get(cache_key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+
+    pending = _INFLIGHT.get(cache_key)
+    if pending is not None:
+        return await pending
+
+    fut: asyncio.Future = asyncio.get_running_loop().create_future()
+    _INFLIGHT[cache_key] = fut
+    try:
+        base = entry[1] if entry else None
+        start = _incremental_start(base, interval, limit)
+        url = _klines_url(symbol, interval, limit)
+        if start is not None:
+            url += f"&startTime={start}"
+        fresh = _parse_klines(await http_get_json_async(url))
+        candles = _merge_klines(base, fresh, limit) if start is not None else fresh
+        _KLINES_CACHE[cache_key] = (time.monotonic() + _klines_ttl(interval), candles)
+        fut.set_result(candles)
+        return candles
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # не ругаться "exception never retrieved", если никто не ждал
+        raise
+    finally:
+        _INFLIGHT.pop(cache_key, None)
+
+
+async def prefetch_klines(symbols: List[str]) -> None:
+    """Прогревает _KLINES_CACHE: D1+H1 всего батча одним asyncio.gather."""
+    tasks = [get_klines_async(s, "1h", H1_LOOKBACK_BARS) for s in symbols]
+    tasks += [get_klines_async(s, "1d", D1_LOOKBACK_BARS) for s in symbols]
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# =====================
+# Вселенная символов
+# =====================
+
+# Последние цены из батчевого тикера: обновляются вместе со вселенной
+_LAST_PRICES: Dict[str, float] = {}
+
+
+def get_last_price(symbol: str) -> Optional[float]:
+    px = _LAST_PRICES.get(symbol)
+    return px if px else None
+
+
+def get_futures_universe() -> List[str]:
+    now = time.monotonic()
+    if _UNIVERSE_CACHE["expiry"] > now and _UNIVERSE_CACHE["data"]:
+        return _UNIVERSE_CACHE["data"]
+
+    # exchangeInfo огромный и меняется редко — свой TTL, переживает рестарты
+    if _UNIVERSE_CACHE["allowed_expiry"] > now and _UNIVERSE_CACHE["allowed"]:
+        allowed = set(_UNIVERSE_CACHE["allowed"])
+    else:
+        ex = http_get_json_conditional(f"{CONFIG['BINANCE_FAPI']}/fapi/v1/exchangeInfo")
+        allowed = {
+            s["symbol"]
+            for s in ex.get("symbols", [])
+            if s.get("contractType") == "PERPETUAL"
+            and s.get("quoteAsset") == "USDT"
+            and s.get("status") == "TRADING"
+        }
+        _UNIVERSE_CACHE["allowed"] = sorted(allowed)
+        _UNIVERSE_CACHE["allowed_expiry"] = now + CONFIG["EXCHANGE_INFO_CACHE_SEC"]
+
+    tickers = http_get_json_conditional(f"{CONFIG['BINANCE_FAPI']}/fapi/v1/ticker/24hr")
+
+    pairs = []
+    for t in tickers or []:
+        if t.get("symbol") not in allowed:
+            continue
+        try:
+            qv = float(t.get("quoteVolume", 0.0))
+        except (TypeError, ValueError):
+            continue
+        # Батчевый тикер уже содержит lastPrice всего рынка — запоминаем даром
+        try:
+            _LAST_PRICES[t["symbol"]] = float(t.get("lastPrice", 0.0))
+        except (TypeError, ValueError):
+            pass
+        if qv >= CONFIG["MIN_QUOTE_VOLUME_USDT"]:
+            pairs.append((qv, t["symbol"]))
+
+    # O(N log K) вместо полной сортировки тикера
+    top = heapq.nlargest(CONFIG["TOP_N_SYMBOLS"], pairs)
+    symbols = [sym for _, sym in top]
+
+    _UNIVERSE_CACHE["expiry"] = time.monotonic() + CONFIG["UNIVERSE_CACHE_SEC"]
+    _UNIVERSE_CACHE["data"] = symbols
+    return symbols
+
+
+# =========================
+# Pivot-помощники (фракталы)
+# =========================
+
+@njit(cache=True, nogil=True)
+def _pivot_scan(values: np.ndarray, left: int, right: int, high: bool) -> np.ndarray:
+    """JIT-кернел пивотов: монотонная дека, O(N) вместо O(N*(L+R)).
+
+    В деке индексы по невозрастанию значения (для high; low — зеркально через
+    sign). Строго меньшие выталкиваются с хвоста, равные остаются — поэтому
+    центр окна является строгим экстремумом ровно тогда, когда он в голове
+    деки и следующий элемент (если есть) строго меньше.
+    """
+    n = values.size
+    out = np.empty(n, dtype=np.int64)
+    m = 0
+    dq = np.empty(n, dtype=np.int64)
+    head = 0
+    tail = 0
+    sign = 1.0 if high else -1.0
+    for i in range(n):
+        v = sign * values[i]
+        while tail > head and sign * values[dq[tail - 1]] < v:
+            tail -= 1
+        dq[tail] = i
+        tail += 1
+        p = i - right  # центр полностью сформированного окна [p-left, p+right]
+        if p < left:
+            continue
+        while dq[head] < p - left:
+            head += 1
+        if dq[head] == p and (tail - head == 1 or sign * values[dq[head + 1]] < sign * values[p]):
+            out[m] = p
+            m += 1
+    return out[:m]
+
+
+def _pivot_indices(values: np.ndarray, left: int, right: int, high: bool) -> np.ndarray:
+    """Индексы строгих экстремумов окна [i-left, i+right]."""
+    n = values.size
+    w = left + right + 1
+    if n < w:
+        return np.empty(0, dtype=np.int64)
+    if _HAVE_NUMBA:
+        return _pivot_scan(values, left, right, high)
+    # NumPy-фоллбек: sliding_window_view + редукции (аллоцирует окна, но без numba)
+    win = sliding_window_view(values, w)
+    center = values[left:n - right]
+    if high:
+        ok = (center > win[:, :left].max(axis=1)) & (center > win[:, left + 1:].max(axis=1))
+    else:
+        ok = (center < win[:, :left].min(axis=1)) & (center < win[:, left + 1:].min(axis=1))
+    return np.flatnonzero(ok) + left
+
+
+# Мемоизация пивотов: бары меняются раз в час/сутки, а пивоты по одному окну
+# запрашиваются по нескольку раз за тик. Ключ — хэш содержимого массива
+# (ts выровнены по бирже и одинаковы у всех символов, по ним ключевать нельзя).
+_PIVOT_CACHE: "OrderedDict[Tuple[int, int, int, int, bool], List[Tuple[int, float]]]" = OrderedDict()
+_PIVOT_CACHE_MAX = 256
+# Мемо-кэши делят воркеры пула анализа: get/move_to_end/popitem — под замком,
+# сами вычисления остаются снаружи
+_MEMO_LOCK = threading.Lock()
+
+
+def _pivots_cached(values: np.ndarray, left: int, right: int, high: bool) -> List[Tuple[int, float]]:
+    key = (hash(values.tobytes()), values.size, left, right, high)
+    with _MEMO_LOCK:
+        hit = _PIVOT_CACHE.get(key)
+        if hit is not None:
+            _PIVOT_CACHE.move_to_end(key)
+            return hit
+    out = [(int(i), float(values[i])) for i in _pivot_indices(values, left, right, high)]
+    with _MEMO_LOCK:
+        _PIVOT_CACHE[key] = out
+        while len(_PIVOT_CACHE) > _PIVOT_CACHE_MAX:
+            _PIVOT_CACHE.popitem(last=False)
+    return out
+
+
+def pivots_high(candles: Candles, left: int, right: int) -> List[Tuple[int, float]]:
+    return _pivots_cached(candles.h, left, right, high=True)
+
+
+def pivots_low(candles: Candles, left: int, right: int) -> List[Tuple[int, float]]:
+    return _pivots_cached(candles.l, left, right, high=False)
+
+
+def _ts_index(ts: np.ndarray, ts_ms: int, interval: str) -> int:
+    """Позиция первого бара с open time >= ts_ms.
+
+    Бары идут с фиксированным шагом, так что обычно это чистая арифметика;
+    при гэпах (делистинг, дыры в истории) откатываемся на бинпоиск.
+    """
+    step = _INTERVAL_MS.get(interval)
+    if step and ts.size:
+        i = (ts_ms - int(ts[0])) // step
+        if 0 <= i < ts.size and ts[i] == ts_ms:
+            return int(i)
+    return int(np.searchsorted(ts, ts_ms))
+
+
+# =========================
+# D1 блоки (эвристика)
+# =========================
+
+# D1 блок меняется при закрытии дневной свечи (и при движении открытого бара),
+# а тик идёт каждые ~25с — мемоизируем результат по содержимому окна
+_D1_BLOCK_CACHE: "OrderedDict[Tuple, List[Dict[str, Any]]]" = OrderedDict()
+_D1_BLOCK_CACHE_MAX = 256
+
+
+def find_d1_blocks(d1: Candles) -> List[Dict[str, Any]]:
+    if len(d1) < 10:
+        return []
+    key = (
+        int(d1.ts[-1]), len(d1),
+        hash(d1.o.tobytes()), hash(d1.h.tobytes()),
+        hash(d1.l.tobytes()), hash(d1.c.tobytes()),
+    )
+    with _MEMO_LOCK:
+        hit = _D1_BLOCK_CACHE.get(key)
+        if hit is not None:
+            _D1_BLOCK_CACHE.move_to_end(key)
+            return hit
+    blocks = _find_d1_blocks_impl(d1)
+    with _MEMO_LOCK:
+        _D1_BLOCK_CACHE[key] = blocks
+        while len(_D1_BLOCK_CACHE) > _D1_BLOCK_CACHE_MAX:
+            _D1_BLOCK_CACHE.popitem(last=False)
+    return blocks
+
+
+def _find_d1_blocks_impl(d1: Candles) -> List[Dict[str, Any]]:
+
+    swing_highs = pivots_high(d1, CONFIG["D1_PIVOT_LEFT"], CONFIG["D1_PIVOT_RIGHT"])
+    swing_lows = pivots_low(d1, CONFIG["D1_PIVOT_LEFT"], CONFIG["D1_PIVOT_RIGHT"])
+
+    n = len(d1)
+    idxs = np.arange(n)
+    bear = is_bear_v(d1.o, d1.c)
+    bull = is_bull_v(d1.o, d1.c)
+    # Индекс последней медвежьей/бычьей свечи не позже i — вместо обратного while
+    prev_bear = np.maximum.accumulate(np.where(bear, idxs, -1))
+    prev_bull = np.maximum.accumulate(np.where(bull, idxs, -1))
+
+    def _freshest_break(swings: List[Tuple[int, float]], prev_opp: np.ndarray,
+                        breaks_up: bool) -> Optional[Tuple[int, float]]:
+        """Самый свежий пробой свинга с имеющейся противоцветной свечой до него.
+
+        Возвращает (j, broken_swing): j — индекс свечи-блока.
+        """
+        if not swings:
+            return None
+        sw_idx = np.fromiter((s[0] for s in swings), dtype=np.int64, count=len(swings))
+        sw_val = np.fromiter((s[1] for s in swings), dtype=np.float64, count=len(swings))
+        ks = np.searchsorted(sw_idx, idxs, side="left") - 1
+        ok = (idxs >= 5) & (ks >= 0)
+        broke = np.zeros(n, dtype=bool)
+        if breaks_up:
+            broke[ok] = d1.h[ok] > sw_val[ks[ok]]
+        else:
+            broke[ok] = d1.l[ok] < sw_val[ks[ok]]
+        cand = np.flatnonzero(broke)
+        if cand.size == 0:
+            return None
+        js = prev_opp[cand - 1]
+        cand, js = cand[js >= 0], js[js >= 0]
+        if cand.size == 0:
+            return None
+        best_j = int(js.max())
+        first_i = int(cand[js == best_j][0])
+        return best_j, float(sw_val[ks[first_i]])
+
+    long_ev = _freshest_break(swing_highs, prev_bear, breaks_up=True)
+    short_ev = _freshest_break(swing_lows, prev_bull, breaks_up=False)
+
+    out: List[Dict[str, Any]] = []
+    # При равенстве нет: j медвежьей и бычьей свечи не совпадают — берём свежайший
+    if long_ev and (not short_ev or long_ev[0] >= short_ev[0]):
+        j, swing = long_ev
+        side = "long"
+    elif short_ev:
+        j, swing = short_ev
+        side = "short"
+    else:
+        return out
+    tol_pct = CONFIG["D1_BLOCK_TOL_PCT"]
+    out.append({
+        "id": f"D1P_{side.upper()}_{int(d1.ts[j])}",
+        "side": side,
+        "kind": "Движущий",
+        "low": float(d1.l[j]),
+        "high": float(d1.h[j]),
+        # Границы с допуском считаются один раз при создании блока
+        "wick_lo": float(d1.l[j]) * (1 - tol_pct),
+        "wick_hi": float(d1.h[j]) * (1 + tol_pct),
+        "ts": int(d1.ts[j]),
+        "broken_swing": swing,
+    })
+
+    # Смягчающий блок: первая свеча после движущего, вернувшаяся к сломанному свингу
+    tol = pct_tol(swing, 0.0015)
+    hit = (d1.l[j + 1:] <= swing + tol) & (d1.h[j + 1:] >= swing - tol)
+    if hit.any():
+        k = j + 1 + int(np.argmax(hit))
+        m_lo = float(min(d1.l[k], swing))
+        m_hi = float(max(d1.h[k], swing))
+        out.append({
+            "id": f"D1M_{side.upper()}_{int(d1.ts[k])}",
+            "side": side,
+            "kind": "Смягчающий",
+            "low": m_lo,
+            "high": m_hi,
+            "wick_lo": m_lo * (1 - tol_pct),
+            "wick_hi": m_hi * (1 + tol_pct),
+            "ts": int(d1.ts[k]),
+            "broken_swing": swing,
+        })
+
+    return out[: CONFIG["MAX_BLOCKS_PER_SYMBOL"]]
+
+
+# =========================
+# H1: касание блока
+# =========================
+
+def find_touch(h1: Candles, block: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if len(h1) < 2:
+        return None
+
+    wick_lo = block.get("wick_lo", block["low"] * (1 - CONFIG["D1_BLOCK_TOL_PCT"]))
+    wick_hi = block.get("wick_hi", block["high"] * (1 + CONFIG["D1_BLOCK_TOL_PCT"]))
+
+    # Последняя (открытая) свеча не считается — маской по закрытым, берём самую свежую
+    mask = ranges_intersect_v(h1.l[:-1], h1.h[:-1], wick_lo, wick_hi)
+    j = int(np.argmax(mask[::-1]))  # argmax по перевёрнутой маске = последний True
+    if not mask[mask.size - 1 - j]:
+        return None
+    i = mask.size - 1 - j
+    body_lo, body_hi = candle_body_range(h1.o[i], h1.c[i])
+    kind = "ТЕЛО" if ranges_intersect(body_lo, body_hi, wick_lo, wick_hi) else "ТЕНЬ"
+    return {"ts": int(h1.ts[i]), "kind": kind}
+
+
+# =========================
+# H1 структура: P1, P2/P3, BOS
+# =========================
+
+@njit(cache=True, nogil=True)
+def _structure_core(ph: np.ndarray, pl: np.ndarray, h: np.ndarray, l: np.ndarray,
+                    c: np.ndarray, p1_i: int, is_short: bool, bos_min_pct: float,
+                    wick_tol_pct: float, use_wick: bool) -> Tuple[int, int, int, bool]:
+    """Скалярный прогон P2/P3/BOS по массивам; NaN в ph/pl = «не пивот»."""
+    n = ph.size
+
+    p2_i = -1
+    for i in range(p1_i + 1, n):
+        v = pl[i] if is_short else ph[i]
+        if v == v:
+            p2_i = i
+            break
+    if p2_i < 0:
+        return -1, -1, -1, False
+
+    p3_i = -1
+    for i in range(p2_i + 1, n):
+        v = ph[i] if is_short else pl[i]
+        if v == v:
+            p3_i = i
+            break
+
+    level = pl[p2_i] if is_short else ph[p2_i]
+    bos_i = -1
+    close_broke = False
+    for i in range(p2_i + 1, n):
+        if is_short:
+            close_break = c[i] < level * (1.0 - bos_min_pct)
+            wick_break = use_wick and l[i] < level - level * wick_tol_pct
+        else:
+            close_break = c[i] > level * (1.0 + bos_min_pct)
+            wick_break = use_wick and h[i] > level + level * wick_tol_pct
+        if close_break or wick_break:
+            bos_i = i
+            close_broke = close_break
+            break
+
+    return p2_i, p3_i, bos_i, close_broke
+
+
+# Между тиками H1-окно чаще всего не меняется (бар закрывается раз в час) —
+# результат разбора структуры мемоизируем по содержимому окна и параметрам
+_STRUCT_CACHE: "OrderedDict[Tuple, Optional[Dict[str, Any]]]" = OrderedDict()
+_STRUCT_CACHE_MAX = 512
+
+
+def detect_structure(h1: Candles, direction: str, touch_ts: int) -> Optional[Dict[str, Any]]:
+    key = (
+        hash(h1.h.tobytes()), hash(h1.l.tobytes()), hash(h1.c.tobytes()),
+        len(h1), direction, touch_ts,
+    )
+    with _MEMO_LOCK:
+        if key in _STRUCT_CACHE:
+            _STRUCT_CACHE.move_to_end(key)
+            return _STRUCT_CACHE[key]
+    result = _detect_structure_impl(h1, direction, touch_ts)
+    with _MEMO_LOCK:
+        _STRUCT_CACHE[key] = result
+        while len(_STRUCT_CACHE) > _STRUCT_CACHE_MAX:
+            _STRUCT_CACHE.popitem(last=False)
+    return result
+
+
+def _detect_structure_impl(h1: Candles, direction: str, touch_ts: int) -> Optional[Dict[str, Any]]:
+
+    idx0 = _ts_index(h1.ts, touch_ts, "1h")
+    seq = h1[idx0:]
+    if len(seq) < 10:
+        return None
+
+    # P1 — экстремум после касания; argmax/argmin берут первый из равных,
+    # как и старый цикл со строгим сравнением
+    if direction == "short":
+        p1_i = int(np.argmax(seq.h))
+        p1 = {"ts": int(seq.ts[p1_i]), "price": float(seq.h[p1_i])}
+    else:
+        p1_i = int(np.argmin(seq.l))
+        p1 = {"ts": int(seq.ts[p1_i]), "price": float(seq.l[p1_i])}
+
+    # Пивоты в виде массивов с NaN-пропусками — так их ест njit-кернел
+    n = len(seq)
+    ph = np.full(n, np.nan)
+    pl = np.full(n, np.nan)
+    for i in _pivot_indices(seq.h, CONFIG["H1_PIVOT_LEFT"], CONFIG["H1_PIVOT_RIGHT"], high=True):
+        ph[i] = seq.h[i]
+    for i in _pivot_indices(seq.l, CONFIG["H1_PIVOT_LEFT"], CONFIG["H1_PIVOT_RIGHT"], high=False):
+        pl[i] = seq.l[i]
+
+    p2_i, p3_i, bos_i, close_broke = _structure_core(
+        ph, pl, seq.h, seq.l, seq.c,
+        p1_i,
+        direction == "short",
+        CONFIG["BOS_MIN_PCT"],
+        CONFIG["BOS_WICK_TOL_PCT"],
+        CONFIG["BOS_MODE"] == "close_or_wick",
+    )
+    if p2_i < 0:
+        return None
+
+    p2_price = float(pl[p2_i] if direction == "short" else ph[p2_i])
+    p2 = {"i": p2_i, "ts": int(seq.ts[p2_i]), "price": p2_price}
+
+    p3 = None
+    if p3_i >= 0:
+        p3_price = float(ph[p3_i] if direction == "short" else pl[p3_i])
+        p3 = {"i": p3_i, "ts": int(seq.ts[p3_i]), "price": p3_price}
+
+    bos = None
+    if bos_i >= 0:
+        bos = {
+            "level": p2_price,
+            "ts": int(seq.ts[bos_i]),
+            "close": float(seq.c[bos_i]),
+            "mode": "подтверждён закрытием" if close_broke else "прокол уровня (по тени)",
         }
-      }
 
-      saveState(state);
-    } catch (e) {
-      state.metrics.last_error = `Цикл: ${String(e.message || e).slice(0, 180)}`;
-      saveState(state);
+    return {"p1": p1, "p2": p2, "p3": p3, "bos": bos}
+
+
+# =========================
+# Ретест после BOS
+# =========================
+
+def detect_retest(
+    h1: Candles,
+    direction: str,
+    bos_ts: int,
+    p2_price: float,
+    p3_price: Optional[float],
+) -> Optional[Dict[str, Any]]:
+    levels = [("P2", p2_price)]
+    if p3_price is not None:
+        levels.append(("P3", p3_price))
+
+    i = _ts_index(h1.ts, bos_ts, "1h")
+    start = i + 1 if i < len(h1) and h1.ts[i] == bos_ts else i
+    if start >= len(h1):
+        return None
+
+    # Первый бар после BOS, зацепивший уровень; при одном баре приоритет у P2
+    best: Optional[Dict[str, Any]] = None
+    for name, level in levels:
+        tol = pct_tol(level, CONFIG["RETEST_TOL_PCT"])
+        hit = ranges_intersect_v(h1.l[start:], h1.h[start:], level - tol, level + tol)
+        if not hit.any():
+            continue
+        i = start + int(np.argmax(hit))
+        if best is None or i < best["_i"]:
+            best = {"level_name": name, "level": level, "ts": int(h1.ts[i]), "_i": i}
+    if best is None:
+        return None
+    best.pop("_i")
+    return best
+
+
+# =========================
+# Telegram
+# =========================
+
+TG_RETRY_MAX = 2
+
+
+def send_telegram(text: str) -> None:
+    if not CONFIG["BOT_TOKEN"] or not CONFIG["CHAT_ID"]:
+        raise RuntimeError("Не задан BOT_TOKEN или CHAT_ID")
+    url = f"https://api.telegram.org/bot{CONFIG['BOT_TOKEN']}/sendMessage"
+    for attempt in range(TG_RETRY_MAX + 1):
+        r = _SESSION.post(
+            url,
+            json={"chat_id": CONFIG["CHAT_ID"], "text": text},
+            timeout=CONFIG["HTTP_TIMEOUT_SEC"],
+        )
+        if r.status_code == 200:
+            return
+        if r.status_code == 429 and attempt < TG_RETRY_MAX:
+            # Telegram сообщает точную паузу в parameters.retry_after
+            try:
+                retry_after = float(r.json()["parameters"]["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                retry_after = 3.0
+            time.sleep(min(retry_after, 60.0))
+            continue
+        raise RuntimeError(f"Telegram error {r.status_code}: {r.text[:200]}")
+
+
+# Исходящие сообщения копятся за тик и уходят одним-двумя POST'ами
+_PENDING_TG: List[str] = []
+TG_JOIN_SEP = "\n\n---\n\n"
+TG_CHUNK_LIMIT = 4000  # лимит Telegram 4096, оставляем запас
+
+
+def queue_telegram(text: str) -> None:
+    _PENDING_TG.append(text)
+
+
+def flush_telegram() -> None:
+    if not _PENDING_TG:
+        return
+    pending, _PENDING_TG[:] = list(_PENDING_TG), []
+
+    chunks: List[str] = []
+    cur = ""
+    for msg in pending:
+        if len(msg) > TG_CHUNK_LIMIT:
+            msg = msg[:TG_CHUNK_LIMIT]
+        if cur and len(cur) + len(TG_JOIN_SEP) + len(msg) > TG_CHUNK_LIMIT:
+            chunks.append(cur)
+            cur = msg
+        else:
+            cur = msg if not cur else cur + TG_JOIN_SEP + msg
+    if cur:
+        chunks.append(cur)
+
+    _tg_enqueue(chunks)
+
+
+# Отправка в фоне: тик не ждёт ни round-trip до Telegram, ни паузы retry_after
+_TG_OUT: "queue.Queue[str]" = queue.Queue()
+_TG_WORKER_STARTED = False
+_TG_WORKER_LOCK = threading.Lock()
+
+
+def _tg_enqueue(chunks: List[str]) -> None:
+    global _TG_WORKER_STARTED
+    if not _TG_WORKER_STARTED:
+        with _TG_WORKER_LOCK:
+            if not _TG_WORKER_STARTED:
+                threading.Thread(target=_tg_worker, name="tg-sender", daemon=True).start()
+                _TG_WORKER_STARTED = True
+    for chunk in chunks:
+        _TG_OUT.put(chunk)
+
+
+def _tg_worker() -> None:
+    while True:
+        chunk = _TG_OUT.get()
+        try:
+            send_telegram(chunk)
+        except Exception as e:  # noqa: BLE001 — воркер не должен умирать
+            set_last_error(f"telegram: {e}")
+            bump_metric("tg_errors")
+        finally:
+            _TG_OUT.task_done()
+
+
+def _tg_drain(timeout: float = 10.0) -> None:
+    """Ждёт опустошения очереди (с дедлайном) — для финального сброса."""
+    deadline = time.monotonic() + timeout
+    while not _TG_OUT.empty() and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+def direction_header(symbol: str, side: str) -> str:
+    return f"{symbol}  |  🟢 ЛОНГ" if side == "long" else f"{symbol}  |  🔴 ШОРТ"
+
+
+def format_signal_message(
+    symbol: str,
+    block: Dict[str, Any],
+    touch: Dict[str, Any],
+    struct: Dict[str, Any],
+    retest: Dict[str, Any],
+) -> str:
+    lines = [direction_header(symbol, block["side"]), ""]
+    lines.append(f"Тип D1 блока: {block['kind']} ({fmt_ts(block['ts'])})")
+    lines.append(f"Диапазон D1: {fmt_price_for(symbol, block['low'])} – {fmt_price_for(symbol, block['high'])}")
+    lines.append("")
+    lines.append(f"Касание блока: {touch['kind']} ({fmt_ts(touch['ts'])})")
+    lines.append(f"P1: {fmt_price_for(symbol, struct['p1']['price'])}")
+    lines.append(f"P2: {fmt_price_for(symbol, struct['p2']['price'])}")
+    lines.append(f"P3: {fmt_price_for(symbol, struct['p3']['price'] if struct['p3'] else None)}")
+    lines.append("")
+    bos = struct["bos"]
+    dir_text = "выше" if block["side"] == "long" else "ниже"
+    lines.append(f"Слом структуры (BOS): {bos['mode']} ({fmt_ts(bos['ts'])})")
+    lines.append(f"Уровень BOS (P2): {fmt_price_for(symbol, bos['level'])}")
+    lines.append(f"Закрытие: {fmt_price_for(symbol, bos['close'])} ({dir_text} уровня)")
+    lines.append(f"Ретест: {retest['level_name']} ({fmt_ts(retest['ts'])})")
+    return "\n".join(lines)
+
+
+# =========================
+# Heartbeat + "настройки обновлены"
+# =========================
+
+def cfg_public_snapshot() -> Dict[str, Any]:
+    # Только то, что реально важно видеть в чате
+    return {
+        "TOP_N_SYMBOLS": CONFIG["TOP_N_SYMBOLS"],
+        "MIN_QUOTE_VOLUME_USDT": CONFIG["MIN_QUOTE_VOLUME_USDT"],
+        "SYMBOLS_PER_TICK": CONFIG["SYMBOLS_PER_TICK"],
+        "D1_BLOCK_TOL_PCT": CONFIG["D1_BLOCK_TOL_PCT"],
+        "H1_PIVOT_LEFT": CONFIG["H1_PIVOT_LEFT"],
+        "H1_PIVOT_RIGHT": CONFIG["H1_PIVOT_RIGHT"],
+        "BOS_MODE": CONFIG["BOS_MODE"],
+        "BOS_WICK_TOL_PCT": CONFIG["BOS_WICK_TOL_PCT"],
+        "RETEST_TOL_PCT": CONFIG["RETEST_TOL_PCT"],
+        "SIGNAL_TTL_HOURS": CONFIG["SIGNAL_TTL_HOURS"],
     }
 
-    await sleep(CFG.TICK_INTERVAL_MS);
-  }
-}
 
-main().catch((e) => {
-  console.error("Фатальная ошибка:", e);
-  process.exit(1);
-});
\ No newline at end of file
+def cfg_hash(snapshot: Dict[str, Any]) -> str:
+    # Детектор изменений, не криптография: FNV-1a по байтам снапшота
+    payload = json.dumps(snapshot, sort_keys=True).encode("utf-8")
+    h = 2166136261
+    for b in payload:
+        h = ((h ^ b) * 16777619) & 0xFFFFFFFF
+    return f"{h:08x}"
+
+
+def notify_if_cfg_changed() -> None:
+    snap = cfg_public_snapshot()
+    h = cfg_hash(snap)
+    st = _get_state()
+    if h == st["last_cfg_hash"]:
+        return
+    lines = ["⚙️ Настройки обновлены"]
+    lines += [f"{k}: {v}" for k, v in snap.items()]
+    queue_telegram("\n".join(lines))
+    st["last_cfg_hash"] = h
+    _mark_state_dirty()
+
+
+def maybe_heartbeat(symbols: List[str]) -> None:
+    hour_key = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H")
+    if get_last_heartbeat_hour_key() == hour_key:
+        return
+
+    m = _get_state()["metrics"]
+    dt = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    lines = [f"💓 Хартбит ({dt} UTC)"]
+    lines.append(f"Инструментов: {len(symbols)}")
+    lines.append(
+        f"Касаний {m.get('touches', 0)} | BOS {m.get('bos', 0)} | "
+        f"ретестов {m.get('retests', 0)} | сигналов {m.get('signals', 0)}"
+    )
+    if m.get("last_error"):
+        lines.append(f"Ошибка: {m['last_error']}")
+
+    queue_telegram("\n".join(lines))
+    set_last_heartbeat_hour_key(hour_key)
+
+
+# =========================
+# Основной цикл
+# =========================
+
+def process_symbol(symbol: str) -> None:
+    # D1/H1 качаются по разу за символ: все этапы анализа видят один снапшот
+    d1 = get_klines(symbol, "1d", D1_LOOKBACK_BARS)
+    blocks = find_d1_blocks(d1)
+    if not blocks:
+        return
+
+    h1 = get_klines(symbol, "1h", H1_LOOKBACK_BARS)
+    for block in blocks:
+        touch = find_touch(h1, block)
+        if not touch:
+            continue
+
+        session_id = f"{block['id']}:{touch['ts']}"
+        # Сессии ведём на пару (символ, блок): перекрывающиеся блоки не
+        # перетирают друг друга и не накручивают метрику каждый тик
+        session_key = f"{symbol}:{block['id']}"
+        if get_symbol_session_id(session_key) != session_id:
+            set_symbol_session_id(session_key, session_id, touch["ts"])
+            bump_metric("touches")
+
+        struct = detect_structure(h1, block["side"], touch["ts"])
+        if not struct or not struct["bos"]:
+            continue
+        # Этапы считаем по факту первого обнаружения, а не при отправке
+        if mark_session_stage(session_key, "bos", struct["bos"]["ts"]):
+            bump_metric("bos")
+
+        retest = detect_retest(
+            h1,
+            block["side"],
+            struct["bos"]["ts"],
+            struct["p2"]["price"],
+            struct["p3"]["price"] if struct["p3"] else None,
+        )
+        if not retest:
+            continue
+        if mark_session_stage(session_key, "retest", retest["ts"]):
+            bump_metric("retests")
+
+        sent_key = f"{symbol}:{session_id}"
+        if was_sent(sent_key):
+            continue
+
+        queue_telegram(format_signal_message(symbol, block, touch, struct, retest))
+        mark_sent(sent_key)
+        bump_metric("signals")
+
+
+# Шумные символы (ошибки сети/делистинг) пробуем реже: удвоение паузы на
+# каждой ошибке, сброс при успехе
+_BACKOFF: Dict[str, Tuple[float, float]] = {}  # symbol -> (next_try_mono, пауза)
+BACKOFF_BASE_SEC = 5.0
+BACKOFF_MAX_SEC = 600.0
+
+
+def pick_round_robin(symbols: List[str]) -> List[str]:
+    n = len(symbols)
+    if not n:
+        return []
+    k = min(CONFIG["SYMBOLS_PER_TICK"], n)
+    idx = get_rr_index() % n
+    end = idx + k
+    # Циклический срез: один-два C-среза вместо поэлементного цикла
+    if end <= n:
+        batch = symbols[idx:end]
+    else:
+        batch = symbols[idx:] + symbols[:end - n]
+    set_rr_index(end % n)
+    return batch
+
+
+# Анализ независим по символам: njit-кернелы и редкие промахи кэша klines
+# (синхронный HTTP) перекрываются в маленьком пуле потоков
+_ANALYSIS_POOL = ThreadPoolExecutor(
+    max_workers=CONFIG["ANALYSIS_WORKERS"], thread_name_prefix="smc"
+)
+
+
+async def main_loop() -> None:
+    while True:
+        started = time.time()
+        try:
+            symbols = get_futures_universe()
+
+            try:
+                notify_if_cfg_changed()
+            except Exception as e:
+                set_last_error(f"Настройки: {e}")
+
+            try:
+                maybe_heartbeat(symbols)
+            except Exception as e:
+                set_last_error(f"Хартбит: {e}")
+
+            batch = pick_round_robin(symbols)
+            # Символы в паузе выкидываем до сети, а не после
+            now_mono = time.monotonic()
+            batch = [s for s in batch if _BACKOFF.get(s, (0.0, 0.0))[0] <= now_mono]
+            # Вся сеть тика — одним gather с дедлайном: один зависший ответ
+            # не должен съедать весь бюджет тика, отставшие символы догонит
+            # round-robin на следующем круге
+            try:
+                await asyncio.wait_for(
+                    prefetch_klines(batch), timeout=CONFIG["TICK_INTERVAL_SEC"] * 0.8
+                )
+            except asyncio.TimeoutError:
+                bump_metric("prefetch_deadline")
+
+            futures = [(sym, _ANALYSIS_POOL.submit(process_symbol, sym)) for sym in batch]
+            for sym, fut in futures:
+                bo = _BACKOFF.get(sym)
+                try:
+                    fut.result()
+                    _BACKOFF.pop(sym, None)
+                except Exception as e:
+                    pause = min((bo[1] * 2 if bo else BACKOFF_BASE_SEC), BACKOFF_MAX_SEC)
+                    _BACKOFF[sym] = (time.monotonic() + pause, pause)
+                    set_last_error(f"{sym}: {e}")
+
+            try:
+                flush_telegram()
+            except Exception as e:
+                set_last_error(f"Telegram: {e}")
+
+            try:
+                _persist_caches()
+            except OSError as e:
+                set_last_error(f"Кэш: {e}")
+        except Exception as e:
+            set_last_error(f"Цикл: {e}")
+
+        try:
+            flush_state()
+        except OSError as e:
+            set_last_error(f"Состояние: {e}")
+
+        elapsed = time.time() - started
+        await asyncio.sleep(max(1.0, CONFIG["TICK_INTERVAL_SEC"] - elapsed))
+
+
+def _shutdown_flush() -> None:
+    """Финальный сброс на диск: дебаунс-состояние и кэши не теряются при стопе."""
+    try:
+        flush_state(force=True)
+    except OSError:
+        pass
+    try:
+        _persist_caches()
+    except OSError:
+        pass
+    _tg_drain()
+
+
+def _warm_jit() -> None:
+    """Прогревает numba-ядра на игрушечных данных, чтобы JIT не попал в первый тик."""
+    if not _HAVE_NUMBA:
+        return
+    try:
+        v = np.array([1.0, 3.0, 2.0, 4.0, 1.0, 5.0, 2.0], dtype=np.float64)
+        _pivot_scan(v, 1, 1, True)
+        _pivot_scan(v, 1, 1, False)
+        nan = np.full(v.size, np.nan)
+        _structure_core(nan, nan, v, v, v, 0, True, 0.001, 0.005, True)
+        _structure_core(nan, nan, v, v, v, 0, False, 0.001, 0.005, True)
+    except Exception:
+        pass  # прогрев не критичен, ошибки здесь не должны ронять бота
+
+
+def main() -> None:
+    if not CONFIG["BOT_TOKEN"]:
+        print("Ошибка: не задан BOT_TOKEN. Пример: BOT_TOKEN=123:ABC CHAT_ID=... python main.py")
+        sys.exit(1)
+    _load_disk_caches()
+    # cache=True уже переиспользует скомпилированные ядра между рестартами;
+    # фоновый прогрев покрывает первый запуск и инвалидации кэша
+    threading.Thread(target=_warm_jit, name="jit-warmup", daemon=True).start()
+    # SIGTERM (systemd/docker stop) превращаем в SystemExit, чтобы сработал finally
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(main_loop())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _shutdown_flush()
+
+
+if __name__ == "__main__":
+    main()